@@ -2,11 +2,13 @@
 # Install the OpenAI client library: pip install openai
 
 import os
-import json
+import functools
+import orjson
 from openai import AzureOpenAI
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from dotenv import load_dotenv
+from smart import SemanticCache, OrjsonProvider, pooled_http_client
 
 # --- IMPORTANT: Configure your Azure OpenAI Credentials ---
 # Set the following environment variables for security.
@@ -29,6 +31,8 @@ load_dotenv()
 AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_DEPLOYMENT_NAME = os.getenv("AZURE_CHAT_DEPLOYMENT")
+# Optional: enables the semantic cache of generated itineraries
+AZURE_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_EMBEDDING_DEPLOYMENT")
 
 # Validate environment variables
 if not all([AZURE_OPENAI_KEY, AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_DEPLOYMENT_NAME]):
@@ -38,14 +42,27 @@ if not all([AZURE_OPENAI_KEY, AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_DEPLOYMENT_NAM
 client = AzureOpenAI(
     api_key=AZURE_OPENAI_KEY,
     azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    api_version="2024-02-15-preview" # Use a modern API version
+    api_version="2024-02-15-preview", # Use a modern API version
+    http_client=pooled_http_client()
 )
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 # Enable CORS to allow the HTML file to make requests to this server
 CORS(app)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "supersecret")
 
+# The system prompt is static, so near-identical prompts can share a cached itinerary.
+ITINERARY_CACHE = SemanticCache(threshold=0.95, path="cache/itineraries")
+
+def orjson_response(obj, status=200):
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+@functools.lru_cache(maxsize=1024)
+def embed_prompt(prompt):
+    res = client.embeddings.create(model=AZURE_EMBEDDING_DEPLOYMENT, input=prompt)
+    return tuple(res.data[0].embedding)
+
 
 @app.route('/generate-itinerary', methods=['POST'])
 def generate_itinerary():
@@ -60,6 +77,18 @@ def generate_itinerary():
         if not prompt_from_frontend:
             return jsonify({"error": "No prompt provided"}), 400
 
+        prompt_vector = None
+        if AZURE_EMBEDDING_DEPLOYMENT:
+            try:
+                prompt_vector = embed_prompt(prompt_from_frontend)
+                cached = ITINERARY_CACHE.get(prompt_vector)
+                if cached is not None:
+                    return orjson_response(cached)
+            except Exception as e:
+                # The cache is only a shortcut; generate uncached instead
+                print(f"[WARN] Itinerary cache lookup failed: {e}")
+                prompt_vector = None
+
         # Create the full prompt for the model
         full_prompt = f"""
             Act as a travel expert. Generate a single, highly-curated point of interest based on the following user input:
@@ -87,7 +116,10 @@ def generate_itinerary():
 
         # Extract the JSON string from the response and parse it
         response_text = response.choices[0].message.content
-        return jsonify(json.loads(response_text)), 200
+        itinerary = orjson.loads(response_text)
+        if prompt_vector is not None:
+            ITINERARY_CACHE.add(prompt_vector, itinerary)
+        return orjson_response(itinerary)
 
     except Exception as e:
         print(f"Error: {e}")
@@ -95,4 +127,4 @@ def generate_itinerary():
 
 if __name__ == '__main__':
     # The server will run on http://127.0.0.1:5000
-    app.run(debug=True)
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1")
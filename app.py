@@ -1,11 +1,20 @@
-from flask import Flask, request, render_template, session, redirect, url_for, jsonify
-import os, json, random, re, urllib.parse
+from flask import Flask, Response, request, render_template, session, redirect, url_for, stream_with_context
+import os, random, re, time, functools, threading, urllib.parse
+from collections import OrderedDict
+import orjson
 from dotenv import load_dotenv
 from openai import AzureOpenAI
+from flask_session import Session
 from smart import (
+    pooled_http_client,
+    jsonl_lines,
+    OrjsonProvider,
     format_chunks,
-    embed_chunks,
+    load_or_embed_chunks,
+    build_embedding_index,
+    build_filter_rows,
     search_similar,           # must accept cuisine=
+    embed_question,
     infer_concourse_from_gate,
     parse_location_code,
     clean_html,
@@ -14,17 +23,38 @@ from smart import (
 load_dotenv()
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "supersecret")
 
+# Server-side sessions: the cookie only carries a session id, so the growing
+# chat history isn't re-serialized and re-signed into a cookie on every turn.
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    import redis
+    app.config["SESSION_TYPE"] = "redis"
+    app.config["SESSION_REDIS"] = redis.from_url(REDIS_URL)
+else:
+    from cachelib.file import FileSystemCache
+    app.config["SESSION_TYPE"] = "cachelib"
+    app.config["SESSION_CACHELIB"] = FileSystemCache(cache_dir="cache/sessions", threshold=1000)
+# Only write the session back when a view changed it; read-only requests
+# (itinerary page, directions) would otherwise re-store the whole history.
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+Session(app)
+
 client = AzureOpenAI(
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
     api_key=os.getenv("AZURE_OPENAI_KEY"),
-    api_version="2023-12-01-preview"
+    api_version="2023-12-01-preview",
+    http_client=pooled_http_client()
 )
 
 EMBED_MODEL = os.getenv("AZURE_EMBEDDING_DEPLOYMENT")
 CHAT_MODEL  = os.getenv("AZURE_CHAT_DEPLOYMENT")
 
+# Resolved once instead of walking client.chat.completions on every call
+_chat_create = client.chat.completions.create
+
 # ----------------------------------
 # HIA Map deep link config (exact rule you asked for)
 # ----------------------------------
@@ -32,6 +62,9 @@ HIA_MAP_BASE = "https://dohahamadairport.com/airport-guide/at-the-airport/maps"
 HIA_MAP_SRC = os.getenv("HIA_MAP_SRC", "B01-UL001-IDA0394")                 # fixed source
 HIA_MAP_FALLBACK_DST = os.getenv("HIA_MAP_FALLBACK_DST", "B01-UL001-IDB0364")  # fallback destination
 
+def orjson_response(obj, status=200):
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
 @app.route("/directions", methods=["GET"])
 def directions():
     """
@@ -42,12 +75,8 @@ def directions():
     - src is always HIA_MAP_SRC
     """
     dst = (request.args.get("dst") or "").strip() or HIA_MAP_FALLBACK_DST
-    url = (
-        f"{HIA_MAP_BASE}"
-        f"?dst={urllib.parse.quote(dst)}"
-        f"&src={urllib.parse.quote(HIA_MAP_SRC)}"
-    )
-    return redirect(url)
+    query = urllib.parse.urlencode({"dst": dst, "src": HIA_MAP_SRC}, safe="/", quote_via=urllib.parse.quote)
+    return redirect(f"{HIA_MAP_BASE}?{query}")
 
 # (Optional) Back-compat: if something still calls /directions/<id>, forward to /directions?dst=<id>
 @app.route("/directions/<path:location_id>", methods=["GET"])
@@ -61,21 +90,18 @@ def load_jsonl(path):
     items = []
     if not os.path.exists(path):
         return items
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                try:
-                    items.append(json.loads(line))
-                except Exception:
-                    pass
+    for line in jsonl_lines(path):
+        try:
+            items.append(orjson.loads(line))
+        except Exception:
+            pass
     return items
 
 airport_data = []
 if os.path.exists("data/airport_data.json"):
     try:
-        with open("data/airport_data.json", "r", encoding="utf-8") as f:
-            airport_data = json.load(f)
+        with open("data/airport_data.json", "rb") as f:
+            airport_data = orjson.loads(f.read())
     except Exception:
         airport_data = []
 
@@ -87,13 +113,29 @@ if airport_data:
 if catalog_data:
     all_chunks.extend(format_chunks(catalog_data))
 
-embedded_chunks = embed_chunks(client, EMBED_MODEL, all_chunks)
+# Embedding runs in a background thread (started below, once every helper it
+# needs is defined) so workers come up immediately; /ask waits on the event.
+# Row i of EMBED_INDEX is all_chunks[i]; the index holds the only copy of the vectors.
+EMBED_INDEX = None
+EMBEDDINGS_READY = threading.Event()
+EMBED_WAIT_SECONDS = float(os.getenv("EMBED_WAIT_SECONDS", "20"))
+# A failed load is retried after 5s, 10s, 20s... (capped); until one succeeds
+# /ask keeps answering 503, and EMBED_ERROR holds the last failure
+EMBED_RETRY_MAX_SECONDS = float(os.getenv("EMBED_RETRY_MAX_SECONDS", "300"))
+EMBED_ERROR = None
 
 # ----------------------------------
 # Catalog index WITH location_ids
 # ----------------------------------
+_NORM_TABLE = str.maketrans("", "", "".join(chr(c) for c in range(128) if not chr(c).isalnum()))
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+
+@functools.lru_cache(maxsize=4096)
 def _norm_name(s: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
+    s = (s or "").lower()
+    if s.isascii():
+        return s.translate(_NORM_TABLE)
+    return _NON_ALNUM_RE.sub("", s)
 
 def build_catalog_index(catalog):
     """
@@ -115,6 +157,8 @@ def build_catalog_index(catalog):
         concourse_txt = parse_location_code(primary_id) if primary_id else "Location info not available"
         cats = row.get("mcn_category", []) or []
         image = row.get("image") or row.get("thumbnail") or None
+        # Concourse letter kept alongside so gate ranking is a plain compare
+        conc_letter = concourse_txt[10:11] if concourse_txt.startswith("Concourse ") else ""
 
         for content in (row.get("mcn_content") or []):
             title = (content.get("mcn_title") or "").strip()
@@ -135,16 +179,24 @@ def build_catalog_index(catalog):
                 "concourse": concourse_txt,
                 "categories": cats,
                 "image": image,
+                "_conc_letter": conc_letter,
             }
             idx.setdefault(_norm_name(title), []).append(item)
     return idx
 
 CATALOG_INDEX = build_catalog_index(catalog_data)
 
-def match_catalog_by_name(name: str):
+def best_catalog_match(name: str, gate: str = ""):
+    """First variant in the gate's concourse, else the first variant; None if unknown."""
     if not name:
-        return []
-    return CATALOG_INDEX.get(_norm_name(name), [])
+        return None
+    candidates = CATALOG_INDEX.get(_norm_name(name))
+    if not candidates:
+        return None
+    gate_letter = (gate or "")[:1].upper()
+    if not gate_letter:
+        return candidates[0]
+    return next((it for it in candidates if it["_conc_letter"] == gate_letter), candidates[0])
 
 # ----------------------------------
 # Random defaults
@@ -162,33 +214,79 @@ CUISINES = [
     "pizza","vegetarian","vegan","dessert","coffee"
 ]
 YES_WORDS = {"yes","y","yeah","yep","sure","okay","ok","please","go ahead","do it"}
-NO_WORDS  = {"no","n","nope","not now","later","don’t","dont"}
+NO_WORDS  = {"no","n","nope","not now","later","don’t","don't","dont"}
+
+# One alternation scanned once, instead of a regex per cuisine per message
+_CUISINE_RE = re.compile(r"\b(" + "|".join(re.escape(c) for c in CUISINES) + r")\b", re.I)
 
 def extract_cuisine(text: str) -> str:
-    t = (text or "").lower()
-    for c in CUISINES:
-        if re.search(rf"\b{re.escape(c)}\b", t):
-            return c
-    return ""
+    m = _CUISINE_RE.search(text or "")
+    return m.group(1).lower() if m else ""
+
+# Whole-word matching, so "yesterday" or "know" don't read as yes/no
+_TOKEN_RE = re.compile(r"[a-z'’]+")
+
+def _split_phrases(words):
+    return {w for w in words if " " not in w}, [w for w in words if " " in w]
+
+_YES_SINGLE, _YES_PHRASES = _split_phrases(YES_WORDS)
+_NO_SINGLE, _NO_PHRASES = _split_phrases(NO_WORDS)
+
+def _says_any(text: str, singles, phrases) -> bool:
+    toks = _TOKEN_RE.findall((text or "").lower())
+    if not singles.isdisjoint(toks):
+        return True
+    joined = " " + " ".join(toks) + " "
+    return any(f" {p} " in joined for p in phrases)
 
 def says_yes(text: str) -> bool:
-    t = (text or "").lower().strip()
-    return any(w in t for w in YES_WORDS)
+    return _says_any(text, _YES_SINGLE, _YES_PHRASES)
 
 def says_no(text: str) -> bool:
-    t = (text or "").lower().strip()
-    return any(w in t for w in NO_WORDS)
+    return _says_any(text, _NO_SINGLE, _NO_PHRASES)
+
+# (cuisine, concourse) pairs that co-occur in some chunk, computed once at
+# startup so the availability check is a set lookup, not a corpus scan.
+# Derived from FILTER_ROWS, so the corpus text is only scanned once.
+CONCOURSE_LABELS = [f"concourse {letter}" for letter in "abcde"] + ["unknown"]
+
+def build_cuisine_concourse_set(filter_rows):
+    conc_rows = {conc: set(filter_rows.get(conc, ())) for conc in CONCOURSE_LABELS}
+    return frozenset(
+        (c, conc)
+        for c in CUISINES
+        for conc, rows in conc_rows.items()
+        if not rows.isdisjoint(filter_rows.get(c, ()))
+    )
+
+CUISINE_CONCOURSE_SET = frozenset()
+FILTER_ROWS = {}
+
+def _init_embeddings():
+    global EMBED_INDEX, FILTER_ROWS, CUISINE_CONCOURSE_SET, EMBED_ERROR
+    delay = 5.0
+    while True:
+        try:
+            embeddings = load_or_embed_chunks(client, EMBED_MODEL, all_chunks)
+            FILTER_ROWS = build_filter_rows(all_chunks, CUISINES + CONCOURSE_LABELS)
+            CUISINE_CONCOURSE_SET = build_cuisine_concourse_set(FILTER_ROWS)
+            EMBED_INDEX = build_embedding_index(embeddings) if len(embeddings) else None
+        except Exception as e:
+            EMBED_ERROR = e
+            print(f"[ERROR] Loading embeddings failed, retrying in {delay:.0f}s: {e!r}")
+            time.sleep(delay)
+            delay = min(delay * 2, EMBED_RETRY_MAX_SECONDS)
+            continue
+        EMBED_ERROR = None
+        EMBEDDINGS_READY.set()
+        return
+
+threading.Thread(target=_init_embeddings, name="embed-chunks", daemon=True).start()
 
 def cuisine_exists_in_concourse(cuisine: str, concourse: str) -> bool:
     if not cuisine or not concourse:
         return False
-    c = cuisine.lower()
-    conc = concourse.lower()
-    for item in embedded_chunks:
-        t = item["text"].lower()
-        if c in t and conc in t:
-            return True
-    return False
+    return (cuisine.lower(), concourse.lower()) in CUISINE_CONCOURSE_SET
 
 # ----------------------------------
 # Itinerary helpers
@@ -226,20 +324,216 @@ CATEGORY_WORDS = {
     "shopping": {"shopping","shop","buy","stores","boutique","retail","gift","souvenir","clothes","apparel","electronics","books","magazine"},
     "relax": {"relax","lounge","spa","rest","massage","quiet","meditate","yoga","nap","sleep","chill","unwind","calm"}
 }
+# One alternation per category, checked in CATEGORY_WORDS order. Keywords
+# must start a word ("shops", "restaurants" still match) so e.g. the "rest"
+# in "interested" or the "eat" in "great" no longer count.
+_CATEGORY_RES = [
+    (cat.title(), re.compile(r"\b(?:" + "|".join(re.escape(w) for w in sorted(words)) + ")"))
+    for cat, words in CATEGORY_WORDS.items()
+]
+
 def detect_category_from_text(text: str) -> str:
     t = (text or "").lower()
-    for cat, words in CATEGORY_WORDS.items():
-        if any(w in t for w in words):
-            return cat.title()
+    for cat, pattern in _CATEGORY_RES:
+        if pattern.search(t):
+            return cat
     return session.get("current_category", "Dining")
 
-# Parse numbered recommendations (expects the HTML we format in system prompt)
-RECO_REGEX = re.compile(
-    r"(\d+)\.\s*<strong>(.*?)</strong>\s*—\s*(.*?)<br>\s*<span[^>]*>(.*?)</span>\s*<br>\s*<span[^>]*>(.*?)</span>",
+# Parse numbered recommendations (expects the HTML we format in system prompt).
+# The bubble is split at each "N." marker that opens an entry (the <strong> name),
+# wherever it sits on the line, and each entry is matched on its own, so a
+# malformed entry can't make a match backtrack across the rest of the bubble.
+RECO_START_RE = re.compile(r"(\d+)\.\s*(?=<strong>)", re.I)
+RECO_ENTRY_RE = re.compile(
+    r"<strong>(.*?)</strong>\s*—\s*(.*?)<br>\s*<span[^>]*>(.*?)</span>\s*<br>\s*<span[^>]*>(.*?)</span>",
     re.S | re.I
 )
+ADD_CMD_RE    = re.compile(r"add\s+(.+?)\s+(?:to|into)\s+my\s+(dining|shopping|relax)\s+itinerary", re.I)
+
 def parse_recos_from_html(html: str):
-    return RECO_REGEX.findall(html or "")
+    parts = RECO_START_RE.split(html or "")
+    recos = []
+    # parts = [preamble, num, entry, num, entry, ...]
+    for num, entry in zip(parts[1::2], parts[2::2]):
+        m = RECO_ENTRY_RE.match(entry)
+        if m:
+            recos.append((num,) + m.groups())
+    return recos
+
+# ----------------------------------
+# System prompts
+# ----------------------------------
+# Built once. They carry no per-request fields, so every completion starts with
+# an identical prefix (eligible for the provider's automatic prompt caching);
+# passenger details and reference data follow in the user message.
+SYSTEM_PROMPT_LOCAL = (
+    "You are a helpful airport assistant. "
+    "If the user picks Dining / Shopping / Relax, ask a brief clarifying question, then list 3–5 options.\n\n"
+    "FORMAT EACH RECOMMENDATION EXACTLY (HTML):\n"
+    "1. <strong>Place Name</strong> — short description<br>\n"
+    "<span style='color:#8a8a8a;font-style:italic;'>located within 5 min walk</span><br>\n"
+    "<span style='color:#8a8a8a;'>Concourse A, Level 1</span>\n\n"
+    "After listing options, say: 'Reply with the number to save it to your itinerary.'\n"
+    "If the requested CUISINE is not found near the gate, explicitly say so and ask permission to search nearby concourses."
+)
+SYSTEM_PROMPT_EXPAND = (
+    "List 3–5 options for the requested CUISINE anywhere in the airport. "
+    "FORMAT (HTML):\n"
+    "1. <strong>Place Name</strong> — short description<br>\n"
+    "<span style='color:#8a8a8a;font-style:italic;'>located within 5 min walk</span><br>\n"
+    "<span style='color:#8a8a8a;'>Concourse A, Level 1</span>\n\n"
+    "End with: 'Reply with the number to save it to your itinerary.'"
+)
+
+# Per-request user message: the fixed layout is assembled once here and only
+# the passenger/reference fields are filled in with str.format per turn.
+_CONTEXT_HEAD = (
+    "(Known context)\nPassenger name: {passenger_name}\nFlight number: {flight_number}\n"
+    "Destination: {destination}\nTime until boarding: {time_to_flight}\nBoarding gate: {gate}\n"
+)
+_CONTEXT_TAIL = "\n\n(Reference data)\n{context}"
+USER_CONTEXT_LOCAL = _CONTEXT_HEAD + "Cuisine (if any): {cuisine}" + _CONTEXT_TAIL
+USER_CONTEXT_EXPAND = _CONTEXT_HEAD + "Cuisine: {cuisine}" + _CONTEXT_TAIL
+
+# ----------------------------------
+# Chat history window (bounded prompt size)
+# ----------------------------------
+# At most HISTORY_WINDOW + HISTORY_FOLD_EVERY messages are sent verbatim. Once
+# that is exceeded, everything but the last HISTORY_WINDOW is folded into a
+# rolling summary, so the summarizer runs once every HISTORY_FOLD_EVERY / 2
+# turns rather than every turn. The fold runs after a reply has streamed, so
+# no turn waits on the summary before its first token.
+HISTORY_WINDOW = 12       # 6 user + 6 assistant messages
+HISTORY_FOLD_EVERY = 6
+SUMMARY_MODEL = os.getenv("AZURE_SUMMARY_DEPLOYMENT") or CHAT_MODEL
+
+def summarize_history(previous_summary: str, messages) -> str:
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"(Earlier summary)\n{previous_summary}\n\n(New messages)\n{transcript}"
+    response = _chat_create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content":
+                "Summarize this conversation between a passenger and an airport assistant in at most 200 tokens. "
+                "Keep the passenger's preferences, places already suggested or saved, and open questions."},
+            {"role": "user", "content": transcript}
+        ],
+        temperature=0, max_tokens=250
+    )
+    return response.choices[0].message.content.strip()
+
+def fold_history() -> None:
+    history = session.get("history", [])
+    start = session.get("history_summary_upto", 0)
+    if len(history) - start <= HISTORY_WINDOW + HISTORY_FOLD_EVERY:
+        return
+    cut = len(history) - HISTORY_WINDOW
+    try:
+        session["history_summary"] = summarize_history(session.get("history_summary", ""), history[start:cut])
+        session["history_summary_upto"] = cut
+        session.modified = True
+    except Exception as e:
+        # The un-folded messages are sent meanwhile; the fold is retried next reply
+        print(f"[WARN] History summary failed: {e}")
+
+def history_for_model():
+    history = session.get("history", [])
+    start = session.get("history_summary_upto", 0)
+    summary = session.get("history_summary")
+    prefix = [{"role": "system", "content": f"Summary of the earlier conversation: {summary}"}] if summary else []
+    return prefix + history[start:]
+
+def append_assistant(content: str) -> None:
+    """Record an assistant turn. Its recommendations are parsed once, here, for number/name picks."""
+    session["history"].append({"role": "assistant", "content": content})
+    session["last_recos"] = parse_recos_from_html(content)
+    session.modified = True
+
+# ----------------------------------
+# Chat completions
+# ----------------------------------
+# Identical prompts (same context, history and question) reuse the earlier
+# reply instead of another Azure round-trip. The key is the serialized
+# message list, so any change in history or reference data is a miss.
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "256"))
+_CHAT_CACHE = OrderedDict()
+_CHAT_CACHE_LOCK = threading.Lock()
+
+def _cached_reply(key: bytes):
+    with _CHAT_CACHE_LOCK:
+        reply = _CHAT_CACHE.get(key)
+        if reply is not None:
+            _CHAT_CACHE.move_to_end(key)
+        return reply
+
+def _cache_reply(key: bytes, reply: str) -> None:
+    with _CHAT_CACHE_LOCK:
+        _CHAT_CACHE[key] = reply
+        _CHAT_CACHE.move_to_end(key)
+        while len(_CHAT_CACHE) > CHAT_CACHE_SIZE:
+            _CHAT_CACHE.popitem(last=False)
+
+def _sse(text: str) -> bytes:
+    return b"data: " + orjson.dumps(text) + b"\n\n"
+
+SSE_DONE = b"event: done\ndata: {}\n\n"
+SSE_ERROR = b"event: error\ndata: {}\n\n"
+
+@functools.lru_cache(maxsize=1024)
+def question_vector(question: str):
+    """embed_question, memoized on the exact text so verbatim repeats skip the API."""
+    q = embed_question(client, EMBED_MODEL, question)
+    q.setflags(write=False)  # shared between callers
+    return q
+
+def stream_reply(messages) -> Response:
+    """
+    Stream the completion as SSE frames (each a JSON string delta), closed by
+    an "event: done" frame, or "event: error" if the completion fails midway.
+    The full reply is appended to history once generation ends; the session
+    was already written when the headers went out, so it is saved again here,
+    and once more if fold_history summarized older turns after "done".
+    """
+    key = orjson.dumps(messages)
+
+    def generate():
+        reply = _cached_reply(key)
+        if reply is not None:
+            yield _sse(reply)
+        else:
+            parts = []
+            try:
+                stream = _chat_create(
+                    model=CHAT_MODEL, messages=messages, temperature=0.7, max_tokens=700, stream=True
+                )
+                for chunk in stream:
+                    # Azure sends a choice-less content-filter chunk first
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield _sse(delta)
+            except Exception as e:
+                print(f"[WARN] Chat completion stream failed: {e}")
+                yield SSE_ERROR
+                return
+            reply = "".join(parts)
+            _cache_reply(key, reply)
+        append_assistant(reply)
+        app.session_interface.save_session(app, session, Response())
+        yield SSE_DONE
+        # The client has the whole reply; fold older history for the next turn
+        fold_history()
+        if session.modified:
+            app.session_interface.save_session(app, session, Response())
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 # ----------------------------------
 # Routes
@@ -286,7 +580,7 @@ def chat():
             f"Hi {passenger_name}, your next flight {flight} to {destination} departs in {time_to_flight} "
             f"from Gate {gate}. What would you like to do while you're here?"
         )
-        session["history"].append({"role": "assistant", "content": first_msg})
+        append_assistant(first_msg)
         session["show_first_options"] = True
         session.modified = True
 
@@ -317,11 +611,15 @@ def ask():
     data = request.get_json(force=True) or {}
     question = (data.get("question") or "").strip()
     if not question:
-        return jsonify({"assistant": "No question provided."}), 400
+        return orjson_response({"assistant": "No question provided."}, 400)
+
+    # A bare number picks from the last recommendation list
+    is_choice = question.isdecimal()
 
     # Track category intent for this turn (used if user replies with a number)
-    session["current_category"] = detect_category_from_text(question)
-    session.modified = True
+    if not is_choice:
+        session["current_category"] = detect_category_from_text(question)
+        session.modified = True
 
     passenger_name = (data.get("passenger_name") or session.get("passenger_name") or "Passenger").strip()
     flight_number  = (data.get("flight_number")  or session.get("flight")  or "Unknown").strip()
@@ -329,55 +627,43 @@ def ask():
     boarding_time  = (data.get("time")          or session.get("time")          or "").strip()
 
     session["history"].append({"role": "user", "content": question})
+    session.modified = True
 
     # ----- Add by explicit command: "add X to my <cat> itinerary"
-    m_add = re.search(r"add\s+(.+?)\s+(?:to|into)\s+my\s+(dining|shopping|relax)\s+itinerary", question, flags=re.I)
+    m_add = ADD_CMD_RE.search(question)
     if m_add:
         place = m_add.group(1).strip()
         cat   = m_add.group(2).title()
 
         # Try to enrich from catalog (location_ids, id, image, concourse, description)
-        matches = match_catalog_by_name(place)
-        if matches:
-            m = matches[0]
+        m = best_catalog_match(place, gate)
+        if m:
             add_to_itinerary(cat, m["name"], m.get("description",""), m.get("concourse",""),
                              "within 5 min walk", m.get("image"), item_id=m.get("id"),
                              location_ids=m.get("location_ids") or [])
         else:
             # fallback using last AI bubble parse
-            last_ai_html = ""
-            for msg in reversed(session["history"]):
-                if msg["role"] == "assistant":
-                    last_ai_html = msg["content"] or ""
-                    break
             desc = walk = conc = ""
-            for _, name, d, w, c in parse_recos_from_html(last_ai_html):
+            for _, name, d, w, c in session.get("last_recos") or []:
                 if name.strip().lower() == place.lower():
                     desc, walk, conc = d, w, c
                     break
             add_to_itinerary(cat, place, desc, conc, walk)
 
         reply = f"{place} has been added to your {cat} itinerary. 🧾"
-        session["history"].append({"role": "assistant", "content": reply})
-        session.modified = True
-        return jsonify({"assistant": reply})
+        append_assistant(reply)
+        return orjson_response({"assistant": reply})
 
     # ----- Add by numeric selection (e.g. "2")
-    if re.fullmatch(r"\d+", question):
+    if is_choice:
         choice_num = int(question)
-        last_ai_html = ""
-        for msg in reversed(session["history"]):
-            if msg["role"] == "assistant":
-                last_ai_html = msg["content"] or ""
-                break
-        matches_html = parse_recos_from_html(last_ai_html)
+        matches_html = session.get("last_recos") or []
         if matches_html and 1 <= choice_num <= len(matches_html):
             _, place, desc, walk, conc = matches_html[choice_num - 1]
 
             # Enrich with catalog IDs/images if available
-            match_list = match_catalog_by_name(place)
-            if match_list:
-                m = match_list[0]
+            m = best_catalog_match(place, gate)
+            if m:
                 add_to_itinerary(
                     session.get("current_category", "Dining"),
                     m["name"],
@@ -395,16 +681,22 @@ def ask():
                 )
 
             reply = f"{place} has been added to your {session.get('current_category','Dining')} itinerary. 🧾"
-            session["history"].append({"role": "assistant", "content": reply})
-            session.modified = True
-            return jsonify({"assistant": reply})
+            append_assistant(reply)
+            return orjson_response({"assistant": reply})
 
         nudger = "I couldn’t interpret that selection. Pick a number from the latest list, or say “add <name> to my itinerary”."
-        session["history"].append({"role": "assistant", "content": nudger})
+        append_assistant(nudger)
+        return orjson_response({"assistant": nudger})
+
+    # ----- Cuisine-aware recommendations (needs the embedded corpus)
+    # After a failed load don't hold the request for EMBED_WAIT_SECONDS; the
+    # background retry is already scheduled
+    wait = 0 if EMBED_ERROR is not None else EMBED_WAIT_SECONDS
+    if not EMBEDDINGS_READY.wait(wait):
+        session["history"].pop()
         session.modified = True
-        return jsonify({"assistant": nudger})
+        return orjson_response({"assistant": "I’m still loading the airport guide — please try again in a moment."}, 503)
 
-    # ----- Cuisine-aware recommendations
     time_to_flight = session.get("time_to_flight") or random_hours_4_to_12()
     destination    = "London (LHR)"
     concourse_name = infer_concourse_from_gate(gate)
@@ -416,42 +708,25 @@ def ask():
         if says_yes(question):
             cuisine = session.pop("pending_cuisine", "")
             session.pop("awaiting_cuisine_expand", None)
-            context = search_similar(client, EMBED_MODEL, question, embedded_chunks, gate="", cuisine=cuisine)
-            system_prompt = (
-                "List 3–5 options for the requested CUISINE anywhere in the airport. "
-                "FORMAT (HTML):\n"
-                "1. <strong>Place Name</strong> — short description<br>\n"
-                "<span style='color:#8a8a8a;font-style:italic;'>located within 5 min walk</span><br>\n"
-                "<span style='color:#8a8a8a;'>Concourse A, Level 1</span>\n\n"
-                "End with: 'Reply with the number to save it to your itinerary.'"
-            )
+            context = search_similar(client, EMBED_MODEL, question, all_chunks, gate="", cuisine=cuisine, index=EMBED_INDEX, filter_rows=FILTER_ROWS, q=question_vector(question))
             messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content":
-                    f"(Known context)\nPassenger name: {passenger_name}\nFlight number: {flight_number}\n"
-                    f"Destination: {destination}\nTime until boarding: {time_to_flight}\nBoarding gate: {gate}\n"
-                    f"Cuisine: {cuisine or 'none'}\n\n(Reference data)\n{context}"
-                }
-            ] + session["history"]
-            response = client.chat.completions.create(
-                model=CHAT_MODEL, messages=messages, temperature=0.7, max_tokens=700
-            )
-            assistant_reply = response.choices[0].message.content
-            session["history"].append({"role": "assistant", "content": assistant_reply})
-            session.modified = True
-            return jsonify({"assistant": assistant_reply})
+                {"role": "system", "content": SYSTEM_PROMPT_EXPAND},
+                {"role": "user", "content": USER_CONTEXT_EXPAND.format(
+                    passenger_name=passenger_name, flight_number=flight_number, destination=destination,
+                    time_to_flight=time_to_flight, gate=gate, cuisine=cuisine or "none", context=context
+                )}
+            ] + history_for_model()
+            return stream_reply(messages)
         elif says_no(question):
             session.pop("pending_cuisine", None)
             session.pop("awaiting_cuisine_expand", None)
             assistant_reply = "No problem. Is there another cuisine you’d like to try instead (e.g., Lebanese, Italian, Thai)?"
-            session["history"].append({"role": "assistant", "content": assistant_reply})
-            session.modified = True
-            return jsonify({"assistant": assistant_reply})
+            append_assistant(assistant_reply)
+            return orjson_response({"assistant": assistant_reply})
         else:
             assistant_reply = "Just to confirm — should I search nearby concourses for more options? (Yes/No)"
-            session["history"].append({"role": "assistant", "content": assistant_reply})
-            session.modified = True
-            return jsonify({"assistant": assistant_reply})
+            append_assistant(assistant_reply)
+            return orjson_response({"assistant": assistant_reply})
 
     # If a cuisine is requested, ensure local availability; otherwise ask to expand
     if cuisine:
@@ -463,40 +738,20 @@ def ask():
                 f"I couldn’t find any {cuisine.title()} options near {concourse_name}. "
                 f"Would you like me to search {nearby_hint} for more choices?"
             )
-            session["history"].append({"role": "assistant", "content": assistant_reply})
-            session.modified = True
-            return jsonify({"assistant": assistant_reply})
+            append_assistant(assistant_reply)
+            return orjson_response({"assistant": assistant_reply})
 
     # Normal local search (respect cuisine + gate)
-    context = search_similar(client, EMBED_MODEL, question, embedded_chunks, gate=gate, cuisine=cuisine)
-    system_prompt = (
-        "You are a helpful airport assistant. "
-        "If the user picks Dining / Shopping / Relax, ask a brief clarifying question, then list 3–5 options.\n\n"
-        "FORMAT EACH RECOMMENDATION EXACTLY (HTML):\n"
-        "1. <strong>Place Name</strong> — short description<br>\n"
-        "<span style='color:#8a8a8a;font-style:italic;'>located within 5 min walk</span><br>\n"
-        "<span style='color:#8a8a8a;'>Concourse A, Level 1</span>\n\n"
-        "After listing options, say: 'Reply with the number to save it to your itinerary.'\n"
-        "If the requested CUISINE is not found near the gate, explicitly say so and ask permission to search nearby concourses."
-    )
+    context = search_similar(client, EMBED_MODEL, question, all_chunks, gate=gate, cuisine=cuisine, index=EMBED_INDEX, filter_rows=FILTER_ROWS, q=question_vector(question))
     messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content":
-            f"(Known context)\nPassenger name: {passenger_name}\nFlight number: {flight_number}\n"
-            f"Destination: {destination}\nTime until boarding: {time_to_flight}\nBoarding gate: {gate}\n"
-            f"Cuisine (if any): {cuisine or 'none'}\n\n(Reference data)\n{context}"
-        }
-    ] + session["history"]
-    response = client.chat.completions.create(
-        model=CHAT_MODEL, messages=messages, temperature=0.7, max_tokens=700
-    )
-    assistant_reply = response.choices[0].message.content
-
+        {"role": "system", "content": SYSTEM_PROMPT_LOCAL},
+        {"role": "user", "content": USER_CONTEXT_LOCAL.format(
+            passenger_name=passenger_name, flight_number=flight_number, destination=destination,
+            time_to_flight=time_to_flight, gate=gate, cuisine=cuisine or "none", context=context
+        )}
+    ] + history_for_model()
     # Keep HTML as-is; index.html should render {{ message.content|safe }}
-    session["history"].append({"role": "assistant", "content": assistant_reply})
-    session.modified = True
-
-    return jsonify({"assistant": assistant_reply})
+    return stream_reply(messages)
 
 @app.route("/scanner", methods=["GET"])
 def scanner():
@@ -530,4 +785,4 @@ def reset():
     return redirect(url_for("chat"))
 
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1")
\ No newline at end of file
@@ -3,105 +3,55 @@ from flask import Flask
 app = Flask(__name__)
 
 import os
-import json
-import faiss
 import numpy as np
 from dotenv import load_dotenv
-from typing import List
-from openai import AzureOpenAI
 
-from bs4 import BeautifulSoup
-import re
-from typing import List
+from smart import SemanticCache
+from corpus import client, embed_query, concourse_of_gate, get_index
 
 # Load Azure OpenAI credentials
 load_dotenv()
 
-client = AzureOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_KEY"),
-    api_version="2023-12-01-preview"
-)
-
-EMBED_MODEL = os.getenv("AZURE_EMBEDDING_DEPLOYMENT")
 CHAT_MODEL = os.getenv("AZURE_CHAT_DEPLOYMENT")
 
-# 1. Load JSON from local file
-def load_airport_data(filepath: str):
-    try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"[ERROR] Could not load local data: {e}")
-        return []
-
-# 2. Format into text chunks
-def clean_html(raw_html):
-    if not raw_html:
-        return ""
-    cleanr = re.compile('<.*?>')
-    return re.sub(cleanr, '', raw_html)
-
-def format_chunks(data):
-    chunks = []
-
-    if isinstance(data, dict):
-        data = [data]
-
-    for item in data:
-        item_type = item.get("mcn_ntype", "")
-        category = ", ".join(item.get("mcn_category", []))
-        location = ", ".join(item.get("mcn_map_location", []))
-        contents = item.get("mcn_content", [])
-
-        for content in contents:
-            title = clean_html(content.get("mcn_title", "") or "").strip()
-            body = clean_html(content.get("mcn_body", "") or "").strip()
-
-            chunk = f"""
-Type: {item_type}
-Title: {title}
-Categories: {category}
-Locations: {location}
-Content: {body}
-            """.strip()
-
-            chunks.append(chunk)
-
-    return chunks
-
-# 3. Embed using Azure OpenAI
-def embed_chunks(chunks: List[str]):
-    print("[INFO] Embedding chunks...")
-    embeddings = []
-    for chunk in chunks:
-        res = client.embeddings.create(
-            input=chunk,
-            model=EMBED_MODEL
-        )
-        embedding = np.array(res.data[0].embedding, dtype="float32")
-        embeddings.append(embedding)
-    return np.array(embeddings)
-
-# 4. Build FAISS index
-def build_index(embeddings):
-    dim = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dim)
-    index.add(embeddings)
-    return index
-
-# 5. Retrieve top-k relevant chunks
-def retrieve(query, chunks, index, k=3):
-    res = client.embeddings.create(
-        input=query,
-        model=EMBED_MODEL
-    )
-    query_vector = np.array(res.data[0].embedding, dtype="float32").reshape(1, -1)
-    distances, indices = index.search(query_vector, k)
-    return [chunks[i] for i in indices[0]]
+# 1. Retrieve top-k relevant chunks
+def top_k(matrix, query_vector, k):
+    """Row ids of the k best dot-product scores, best first: one BLAS GEMV + an O(N) partition."""
+    scores = matrix @ query_vector
+    if k >= len(scores):
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, k)[:k]
+    return top[np.argsort(-scores[top])]
+
+def retrieve(query, chunks, corpus, k=3, gate="", concourse_rows=None):
+    """Scores only the gate's concourse when it has chunks, else the whole corpus."""
+    query_vector = embed_query(query)[0]
+    candidates = (concourse_rows or {}).get(concourse_of_gate(gate))
+    if candidates is not None and len(candidates):
+        top = candidates[top_k(corpus[candidates], query_vector, k)]
+    else:
+        top = top_k(corpus, query_vector, k)
+    return [chunks[i] for i in top]
+
+# 2. Generate answer with Azure OpenAI
+# One cache per concourse scope, since gate-filtered context changes the answer
+ANSWER_CACHES = {}
+
+def answer_cache(scope: str = "") -> SemanticCache:
+    if scope not in ANSWER_CACHES:
+        path = f"cache/answers-{scope}" if scope else "cache/answers"
+        ANSWER_CACHES[scope] = SemanticCache(threshold=0.95, path=path)
+    return ANSWER_CACHES[scope]
+
+def generate_answer(query, context_chunks, scope=""):
+    """Yields the answer as it streams in; cache hits are yielded whole."""
+    query_vector = embed_query(query)
+    cache = answer_cache(scope)
+    cached = cache.get(query_vector)
+    if cached is not None:
+        yield cached
+        return
 
-# 6. Generate answer with Azure OpenAI
-def generate_answer(query, context_chunks):
     context = "\n\n".join(context_chunks)
     prompt = f"""
 You are a helpful assistant for airport-related queries. Use the airport information below to answer the user's question.
@@ -122,32 +72,41 @@ Answer:
             {"role": "user", "content": prompt}
         ],
         temperature=0.7,
-        max_tokens=500
+        max_tokens=500,
+        stream=True
     )
 
-    return response.choices[0].message.content.strip()
+    parts = []
+    for chunk in response:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            parts.append(delta)
+            yield delta
 
-# 7. Main loop
+    cache.add(query_vector, "".join(parts).strip())
+
+# 3. Main loop
 def main():
     print("[INFO] Loading local airport data...")
-    data = load_airport_data("data/airport_data.json")
-    if not data:
+    chunks, corpus, concourse_rows = get_index()
+    if not chunks:
         return
 
-    chunks = format_chunks(data)
-    embeddings = embed_chunks(chunks)
-    index = build_index(embeddings)
+    gate = input("\nYour boarding gate, e.g. C31 (optional):\n>> ").strip()
+    scope = concourse_of_gate(gate) if concourse_of_gate(gate) in concourse_rows else ""
 
     while True:
         query = input("\nAsk your airport question (or type 'exit'):\n>> ").strip()
         if query.lower() in ["exit", "quit"]:
+            for cache in ANSWER_CACHES.values():
+                cache.save()
             break
 
-        context = retrieve(query, chunks, index)
-        answer = generate_answer(query, context)
-
+        context = retrieve(query, chunks, corpus, gate=gate, concourse_rows=concourse_rows)
         print("\n--- Answer ---")
-        print(answer)
+        for part in generate_answer(query, context, scope=scope):
+            print(part, end="", flush=True)
+        print()
 
 if __name__ == "__main__":
     main()
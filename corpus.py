@@ -0,0 +1,200 @@
+"""
+Airport corpus loading shared by the retrieval entrypoints.
+
+get_index() loads data/airport_data.json, formats and embeds the chunks
+(cached on disk by content hash) and builds the normalized search matrix,
+once per process.
+"""
+import os
+import re
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+import orjson
+from dotenv import load_dotenv
+from openai import AzureOpenAI, APIStatusError
+
+from smart import pooled_http_client, cached_embeddings, atomic_write
+
+# Load Azure OpenAI credentials
+load_dotenv()
+
+client = AzureOpenAI(
+    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+    api_key=os.getenv("AZURE_OPENAI_KEY"),
+    api_version="2023-12-01-preview",
+    http_client=pooled_http_client(),
+    max_retries=5  # SDK backs off on 429s from concurrent embedding batches
+)
+
+EMBED_MODEL = os.getenv("AZURE_EMBEDDING_DEPLOYMENT")
+# Optional, text-embedding-3-* only: shorter (Matryoshka-truncated) vectors, e.g. 384
+EMBED_DIMENSIONS = int(os.getenv("AZURE_EMBEDDING_DIMENSIONS") or 0)
+EMBED_KWARGS = {"dimensions": EMBED_DIMENSIONS} if EMBED_DIMENSIONS else {}
+# Identifies the vector space in cache keys
+EMBED_ID = f"{EMBED_MODEL}@{EMBED_DIMENSIONS}" if EMBED_DIMENSIONS else EMBED_MODEL
+
+# 1. Load JSON from local file
+def load_airport_data(filepath: str):
+    try:
+        with open(filepath, "rb") as f:
+            return orjson.loads(f.read())
+    except Exception as e:
+        print(f"[ERROR] Could not load local data: {e}")
+        return []
+
+# 2. Format into text chunks
+_TAG_RE = re.compile(r'<[^>\n]*>')
+
+def clean_html(raw_html):
+    return _TAG_RE.sub('', raw_html) if raw_html else ""
+
+def format_chunks(data):
+    chunks = []
+
+    if isinstance(data, dict):
+        data = [data]
+
+    for item in data:
+        item_type = item.get("mcn_ntype", "")
+        # Per-item fields are joined once, not once per content entry
+        category = ", ".join(item.get("mcn_category", []))
+        location = ", ".join(item.get("mcn_map_location", []))
+        contents = item.get("mcn_content", [])
+
+        for content in contents:
+            title = clean_html(content.get("mcn_title", "") or "").strip()
+            body = clean_html(content.get("mcn_body", "") or "").strip()
+
+            chunks.append("\n".join((
+                f"Type: {item_type}",
+                f"Title: {title}",
+                f"Categories: {category}",
+                f"Locations: {location}",
+                f"Content: {body}",
+            )))
+
+    return chunks
+
+# 3. Embed using Azure OpenAI
+def _normalize_rows(x):
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return x / norms
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "8"))
+
+def _embed_batch(batch: List[str]):
+    # The endpoint answers in input order; halve the batch if it is too large (413).
+    try:
+        res = client.embeddings.create(input=batch, model=EMBED_MODEL, **EMBED_KWARGS)
+    except APIStatusError as e:
+        if e.status_code != 413 or len(batch) == 1:
+            raise
+        mid = len(batch) // 2
+        return _embed_batch(batch[:mid]) + _embed_batch(batch[mid:])
+    return [d.embedding for d in res.data]
+
+def _embed_uncached(chunks: List[str]):
+    # Batches go out concurrently; map() keeps them in input order
+    batches = [chunks[i:i + EMBED_BATCH_SIZE] for i in range(0, len(chunks), EMBED_BATCH_SIZE)]
+    if not batches:
+        return np.empty((0, 0), dtype="float32")
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool:
+        rows = [row for batch_rows in pool.map(_embed_batch, batches) for row in batch_rows]
+    return np.asarray(rows, dtype="float32")
+
+# Embeddings persist across runs, keyed by SHA-256(model[@dims] + chunk text),
+# in the same per-chunk store smart.load_or_embed_chunks uses
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "cache/corpus-embeds")
+
+def _chunk_key(chunk: str) -> str:
+    return hashlib.sha256((EMBED_ID + "\x00" + chunk).encode()).hexdigest()
+
+def embed_chunks(chunks: List[str]):
+    print("[INFO] Embedding chunks...")
+    keys = [_chunk_key(c) for c in chunks]
+    vectors = cached_embeddings(EMBED_CACHE_PATH, keys, chunks, _embed_uncached)
+    return np.ascontiguousarray(vectors, dtype="float32")
+
+@functools.lru_cache(maxsize=1024)
+def embed_query(query: str):
+    res = client.embeddings.create(
+        input=query,
+        model=EMBED_MODEL,
+        **EMBED_KWARGS
+    )
+    # Unit length, like the corpus rows, so cosine is a plain dot product
+    query_vector = _normalize_rows(np.array(res.data[0].embedding, dtype="float32").reshape(1, -1))
+    query_vector.setflags(write=False)  # shared between cache hits
+    return query_vector
+
+# 4. Build the search matrix (row-normalized, so cosine is a dot product)
+def build_corpus(embeddings):
+    return np.ascontiguousarray(_normalize_rows(embeddings), dtype=np.float32)
+
+# Chunks + search matrix persist between runs; the matrix is memory-mapped on load
+CORPUS_PATH = os.getenv("CORPUS_PATH", "cache/corpus")
+
+def _corpus_fingerprint(data) -> str:
+    payload = EMBED_ID.encode() + b"\x00" + orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+def load_or_build_corpus(data):
+    fingerprint = _corpus_fingerprint(data)
+    meta_path, matrix_path = f"{CORPUS_PATH}.json", f"{CORPUS_PATH}.npy"
+    if os.path.exists(meta_path) and os.path.exists(matrix_path):
+        try:
+            with open(meta_path, "rb") as f:
+                meta = orjson.loads(f.read())
+            if meta.get("fingerprint") == fingerprint:
+                print("[INFO] Loaded cached corpus.")
+                return meta["chunks"], np.load(matrix_path, mmap_mode="r")
+        except Exception as e:
+            print(f"[WARN] Ignoring unreadable corpus cache: {e}")
+
+    # Duplicate boilerplate chunks would be embedded, stored and retrieved
+    # repeatedly; chunk text is all the answer needs, so keep one of each.
+    chunks = list(dict.fromkeys(format_chunks(data)))
+    corpus = build_corpus(embed_chunks(chunks))
+
+    try:
+        atomic_write(matrix_path, corpus)
+        atomic_write(meta_path, orjson.dumps({"fingerprint": fingerprint, "chunks": chunks}))
+    except OSError as e:
+        print(f"[WARN] Could not write corpus cache {CORPUS_PATH}: {e}")
+    return chunks, corpus
+
+# Concourse letter -> corpus rows, from each item's structured mcn_map_location
+def concourse_of_gate(gate: str) -> str:
+    letter = (gate or "").strip()[:1].upper()
+    return letter if letter in "ABCDE" else ""
+
+def build_concourse_rows(data, chunks):
+    row_of = {c: i for i, c in enumerate(chunks)}
+    rows = {}
+    for item in data:
+        letters = set()
+        for code in item.get("mcn_map_location", []) or []:
+            parts = code.split("-")
+            if len(parts) == 3 and len(parts[2]) > 2:
+                letters.add(parts[2][2].upper())
+        if not letters:
+            continue
+        for chunk in format_chunks(item):
+            for letter in letters:
+                rows.setdefault(letter, set()).add(row_of[chunk])
+    return {letter: np.array(sorted(ids), dtype=np.int64) for letter, ids in rows.items()}
+
+# Process-wide entrypoint: (chunks, search matrix, concourse letter -> rows)
+@functools.cache
+def get_index(path: str = "data/airport_data.json"):
+    data = load_airport_data(path)
+    if not data:
+        return [], np.empty((0, 0), dtype=np.float32), {}
+    chunks, corpus = load_or_build_corpus(data)
+    return chunks, corpus, build_concourse_rows(data, chunks)
@@ -0,0 +1,19 @@
+# Production server config:
+#   gunicorn -c gunicorn.conf.py app:app
+#   gunicorn -c gunicorn.conf.py api_handler:app
+#
+# The app is I/O-bound (Azure OpenAI calls), so gevent workers let many
+# in-flight requests overlap. The gevent worker monkey-patches the stdlib
+# before loading the app, so the OpenAI/httpx client cooperates with it;
+# this gives async-style multiplexing without rewriting views as async.
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "gevent"
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", "200"))
+# Streamed answers hold an Azure connection for the whole reply; size each
+# worker's httpx pool (smart.pooled_http_client) so greenlets don't queue on it.
+os.environ.setdefault("HTTP_MAX_CONNECTIONS", str(worker_connections))
+# Chat completions can take a while; don't kill workers mid-answer
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
@@ -1,7 +1,87 @@
+import io
+import os
 import re
+import mmap
+import bisect
+import functools
+import time
+import random
+import hashlib
+import tempfile
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import httpx
 import numpy as np
-from typing import List, Dict, Optional
+import orjson
+from openai import RateLimitError
+from flask.json.provider import DefaultJSONProvider
+from typing import Callable, List, Dict, Iterator, Optional
 
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process cache lock
+    fcntl = None
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+# httpx drops idle connections after 5s by default, i.e. between most chat
+# turns; keep them long enough that the next /ask skips the TLS handshake.
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+def pooled_http_client(timeout: float = 30.0) -> httpx.Client:
+    """Keep-alive (60s idle) + HTTP/2 pool for AzureOpenAI(http_client=...); reconnects retried 3x."""
+    transport = httpx.HTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=max(HTTP_MAX_CONNECTIONS // 2, 1),
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    return httpx.Client(timeout=timeout, transport=transport)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """app.json = OrjsonProvider(app): jsonify/get_json via orjson (indent/sort options are ignored)."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+_JSONL_LINE_RE = re.compile(rb"\S[^\n]*")
+
+def jsonl_lines(path: str) -> Iterator[memoryview]:
+    """
+    Non-blank lines of a JSONL file as views into an mmap of it, for
+    orjson.loads: no buffered reads, no per-line bytes copies or strip().
+    """
+    if not os.path.getsize(path):
+        return
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # Not closed explicitly: the yielded views keep the map alive, and it is
+    # unmapped once the last of them is dropped
+    view = memoryview(mm)
+    for m in _JSONL_LINE_RE.finditer(mm):
+        yield view[m.start():m.end()]
+
+_AREA_NAMES = {
+    "A": "Concourse A",
+    "B": "Concourse B",
+    "C": "Concourse C",
+    "D": "Concourse D",
+    "E": "Concourse E",
+    "L": "Landside",
+    "U": "Unknown Area"
+}
+# Both cases keyed, as for gates, so a lookup needs no .upper() copy
+_AREA_NAMES.update({letter.lower(): name for letter, name in list(_AREA_NAMES.items())})
+
+# Pure in the code string, so repeats (shared locations, body mentions) are a dict probe
+@functools.lru_cache(maxsize=4096)
 def parse_location_code(code: str) -> str:
     parts = code.split("-")
     if len(parts) != 3:
@@ -11,30 +91,28 @@ def parse_location_code(code: str) -> str:
     level_str = f"Level {level}"
     area_code = parts[2]
     area_letter = area_code[2]
-    concourse_map = {
-        "A": "Concourse A",
-        "B": "Concourse B",
-        "C": "Concourse C",
-        "D": "Concourse D",
-        "E": "Concourse E",
-        "L": "Landside",
-        "U": "Unknown Area"
-    }
-    concourse = concourse_map.get(area_letter.upper(), f"Area {area_letter}")
+    # `or`, not a get() default: the fallback string is only built on a miss
+    concourse = _AREA_NAMES.get(area_letter) or f"Area {area_letter}"
     return f"{concourse}, {level_str}"
 
+# Exactly what '<.*?>' matched (up to the first '>' on the same line), as a
+# greedy negated class: one linear sweep per tag, no lazy-quantifier stepping.
+_TAG_RE = re.compile(r'<[^>\n]*>')
+_LOC_RE = re.compile(r'B01-UL\d{3}-ID([A-Z])\d{4}')
+
 def clean_html(raw_html: str) -> str:
-    if not raw_html:
-        return ""
-    cleanr = re.compile('<.*?>')
-    return re.sub(cleanr, '', raw_html)
+    # A C-level substring scan lets plain-text bodies skip the regex entirely
+    if not raw_html or "<" not in raw_html:
+        return raw_html or ""
+    return _TAG_RE.sub('', raw_html)
+
+def _location_repl(match) -> str:
+    return parse_location_code(match.group(0))
 
 def replace_location_codes(text: str) -> str:
-    pattern = r'B01-UL\d{3}-ID([A-Z])\d{4}'
-    def repl(_match):
-        code = _match.group(0)
-        return parse_location_code(code)
-    return re.sub(pattern, repl, text)
+    if "B01-UL" not in text:
+        return text
+    return _LOC_RE.sub(_location_repl, text)
 
 def format_chunks(data: List[Dict]) -> List[str]:
     chunks = []
@@ -43,94 +121,357 @@ def format_chunks(data: List[Dict]) -> List[str]:
         raw_locations = entry.get("mcn_map_location", [])
         locations = ", ".join([parse_location_code(loc) for loc in raw_locations]) or "No location info"
         categories = ", ".join(entry.get("mcn_category", [])) or "No categories"
+        # Shared by every language version of the entry, so formatted once
+        head = f"Type: {ntype}\nTitle: "
+        meta = f"\nCategories: {categories}\nLocations: {locations}\nLanguage: "
         for content in entry.get("mcn_content", []):
             title = content.get("mcn_title", "").strip()
             body_raw = clean_html(content.get("mcn_body", "")).strip()
             body = replace_location_codes(body_raw)
             lang = content.get("mcn_language", "en")
             # IMPORTANT: keep key terms (title, categories, locations, body) in the text we embed/filter on
-            text = (
-                f"Type: {ntype}\n"
-                f"Title: {title}\n"
-                f"Categories: {categories}\n"
-                f"Locations: {locations}\n"
-                f"Language: {lang}\n"
-                f"Content: {body}"
-            )
-            chunks.append(text)
+            chunks.append(f"{head}{title}{meta}{lang}\nContent: {body}")
     return chunks
 
-def embed_chunks(client, model, chunks: List[str]) -> List[Dict]:
-    embeddings = []
-    for chunk in chunks:
-        res = client.embeddings.create(model=model, input=chunk)
-        embedding = res.data[0].embedding
-        embeddings.append({"text": chunk, "embedding": embedding})
-    return embeddings
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "5"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+
+def _embed_batch(client, model, batch: List[str], delay: float):
+    time.sleep(delay)
+    # Startup sends every batch at once; back off 1s, 2s, 4s... (jittered) on 429
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            return client.embeddings.create(model=model, input=batch).data
+        except RateLimitError:
+            if attempt == EMBED_MAX_RETRIES:
+                raise
+            time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.5))
+
+def embed_chunks(client, model, chunks: List[str]) -> np.ndarray:
+    """(len(chunks), d) float32 matrix, row i embedding chunks[i]."""
+    batches = [chunks[i:i + EMBED_BATCH_SIZE] for i in range(0, len(chunks), EMBED_BATCH_SIZE)]
+    # Up to EMBED_WORKERS requests in flight; the first wave is jittered so it
+    # doesn't land as one burst (429s). map() keeps batches in input order.
+    delays = [random.uniform(0, 0.25) if i < EMBED_WORKERS else 0.0 for i in range(len(batches))]
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool:
+        results = pool.map(lambda b, d: _embed_batch(client, model, b, d), batches, delays)
+        # res.data carries each item's position in its batch; don't rely on response order
+        vectors = [d.embedding for data in results for d in sorted(data, key=lambda d: d.index)]
+    if not vectors:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.asarray(vectors, dtype=np.float32)
+
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "cache")
+# The index quantizes to fp16 anyway, so the cache stores (and maps) half the bytes
+EMBED_CACHE_DTYPE = np.float16
+
+def _chunk_key(model: str, chunk: str) -> str:
+    return hashlib.sha256((model + "\x00" + chunk).encode()).hexdigest()
+
+@contextlib.contextmanager
+def file_lock(path: str, poll: float = 0.25):
+    """
+    Exclusive advisory lock on path, held across processes (e.g. gunicorn workers).
+    Polled with LOCK_NB + time.sleep rather than a blocking flock, which gevent
+    can't patch: other greenlets keep running while a worker waits its turn.
+    """
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "ab") as f:
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(poll)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def atomic_write(path: str, data):
+    """Write bytes (or np.save an array) to a unique temp file, then rename it over path."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if isinstance(data, np.ndarray):
+                np.save(f, data)
+            else:
+                f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def cached_embeddings(base: str, keys: List[str], chunks: List[str],
+                      embed: Callable[[List[str]], np.ndarray]) -> np.ndarray:
+    """
+    Rows for chunks from the store base.npy (fp16 vectors) + base.keys.npy (one
+    key per row); only chunks whose key is missing go through embed(texts),
+    which returns their (n, d) matrix. Runs under base.lock so workers starting
+    together embed once and the rest read the result. A failed cache write is
+    logged and the in-memory vectors are still returned.
+    """
+    with file_lock(base + ".lock"):
+        cached_keys, vectors = [], None
+        if os.path.exists(base + ".npy") and os.path.exists(base + ".keys.npy"):
+            try:
+                # Uncompressed + memory-mapped: startup maps the file instead of inflating it
+                vectors = np.load(base + ".npy", mmap_mode="r")
+                cached_keys = np.load(base + ".keys.npy").tolist()
+                if len(cached_keys) != len(vectors):
+                    cached_keys, vectors = [], None
+            except Exception as e:
+                print(f"[WARN] Ignoring unreadable embedding cache: {e}")
+                cached_keys, vectors = [], None
+
+        if vectors is not None and cached_keys == keys:
+            return vectors
+
+        rows = {k: i for i, k in enumerate(cached_keys)}
+        missing = {}
+        for key, chunk in zip(keys, chunks):
+            if key not in rows:
+                missing.setdefault(key, chunk)
+        if missing:
+            print(f"[INFO] {len(missing)} of {len(chunks)} chunks not cached, embedding...")
+            fresh = embed(list(missing.values()))
+            if vectors is None or vectors.shape[1] != fresh.shape[1]:
+                cached_keys, vectors, rows = [], np.empty((0, fresh.shape[1]), dtype=EMBED_CACHE_DTYPE), {}
+            for key in missing:
+                rows[key] = len(cached_keys)
+                cached_keys.append(key)
+            vectors = np.concatenate([vectors, fresh]).astype(EMBED_CACHE_DTYPE, copy=False)
+            try:
+                atomic_write(base + ".npy", vectors)
+                atomic_write(base + ".keys.npy", np.array(cached_keys))
+            except OSError as e:
+                print(f"[WARN] Could not write embedding cache {base}: {e}")
+
+    if not chunks:
+        return np.empty((0, 0), dtype=EMBED_CACHE_DTYPE)
+    return np.ascontiguousarray(vectors[[rows[k] for k in keys]], dtype=EMBED_CACHE_DTYPE)
 
-def cosine_similarity(a, b):
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+def load_or_embed_chunks(client, model, chunks: List[str]) -> np.ndarray:
+    """
+    embed_chunks, memoized per chunk under cache/embeds-<model>.npy + .keys.npy
+    (SHA-256 of model + text), so restarts and catalog edits only send new or
+    changed chunks to the API.
+    """
+    base = os.path.join(EMBED_CACHE_DIR, "embeds-" + hashlib.sha1(model.encode()).hexdigest()[:12])
+    keys = [_chunk_key(model, c) for c in chunks]
+    return cached_embeddings(base, keys, chunks, lambda texts: embed_chunks(client, model, texts))
+
+# Only the gate's first letter matters, so this is a single table lookup
+_GATE_CONCOURSE = {letter: f"Concourse {letter}" for letter in "ABCDE"}
+_GATE_CONCOURSE.update({letter.lower(): name for letter, name in list(_GATE_CONCOURSE.items())})
 
 def infer_concourse_from_gate(gate: str) -> str:
-    if not gate or len(gate) < 1:
-        return "Unknown"
-    letter = gate[0].upper()
-    return {
-        "A": "Concourse A",
-        "B": "Concourse B",
-        "C": "Concourse C",
-        "D": "Concourse D",
-        "E": "Concourse E"
-    }.get(letter, "Unknown")
-
-def _filter_by_cuisine(chunks: List[Dict], cuisine: str) -> List[Dict]:
-    if not cuisine:
-        return []
-    c = cuisine.lower()
-    out = []
-    for item in chunks:
-        t = item["text"].lower()
-        # match cuisine word in title/categories/content
-        if c in t:
-            out.append(item)
-    return out
+    return _GATE_CONCOURSE.get(gate[:1], "Unknown") if gate else "Unknown"
+
+def _rows_matching(texts_lower: List[str], needle: str) -> np.ndarray:
+    return np.fromiter((i for i, t in enumerate(texts_lower) if needle in t), dtype=np.int64)
+
+def build_filter_rows(texts: List[str], needles: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Row ids per lowercase cuisine/concourse needle, so search_similar needn't
+    rescan the corpus. Texts are lowercased here, transiently, rather than a
+    lowered copy of every chunk being kept around for request-time filters.
+    """
+    texts_lower = [t.lower() for t in texts]
+    return {n: _rows_matching(texts_lower, n) for n in needles}
+
+# "fp16" (default) halves memory with exact ranking; "int8" quarters it;
+# "flat" scores the cached vectors as-is; "hnsw" trades exactness for O(log N)
+# search once the catalog gets large.
+EMBED_INDEX_TYPE = os.getenv("EMBED_INDEX_TYPE", "fp16")
+
+def build_embedding_index(embeddings: np.ndarray, kind: Optional[str] = None) -> faiss.Index:
+    """Normalized chunk embeddings in a FAISS inner-product index of the given kind."""
+    kind = kind or EMBED_INDEX_TYPE
+    # Copy: normalized in place, and the cached matrix may be a read-only mmap
+    matrix = np.array(embeddings, dtype=np.float32)
+    faiss.normalize_L2(matrix)
+    d = matrix.shape[1]
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(d, 32, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = 80
+        index.hnsw.efSearch = 64
+    elif kind == "int8":
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        index.train(matrix)
+    elif kind == "flat":
+        index = faiss.IndexFlatIP(d)
+    else:
+        index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    index.add(matrix)
+    return index
+
+def embed_question(client, model, question: str) -> np.ndarray:
+    """(1, d) L2-normalized float32 query vector."""
+    res = client.embeddings.create(model=model, input=question)
+    q = np.asarray([res.data[0].embedding], dtype=np.float32)
+    faiss.normalize_L2(q)
+    return q
 
 def search_similar(
     client,
     model,
     question: str,
-    embedded_chunks: List[Dict],
+    texts: List[str],
+    embeddings: Optional[np.ndarray] = None,
     gate: str = "",
-    cuisine: Optional[str] = None
+    cuisine: Optional[str] = None,
+    index: Optional[faiss.Index] = None,
+    filter_rows: Optional[Dict[str, np.ndarray]] = None,
+    k: int = 3,
+    q: Optional[np.ndarray] = None
 ) -> str:
-    """Optionally prioritizes cuisine matches; falls back to concourse, then global."""
+    """Optionally prioritizes cuisine matches; falls back to concourse, then global.
+    texts[i] is the chunk embedded at row i of embeddings / index (pass either).
+    Pass q (from embed_question) to reuse an already computed query vector."""
+    def rows_for(needle: str) -> np.ndarray:
+        if filter_rows is not None and needle in filter_rows:
+            return filter_rows[needle]
+        return _rows_matching([t.lower() for t in texts], needle)
+
+    if index is None:
+        if embeddings is None or not len(embeddings):
+            return ""
+        index = build_embedding_index(embeddings)
+
     # Embed question
-    res = client.embeddings.create(model=model, input=question)
-    q_embedding = res.data[0].embedding
+    if q is None:
+        q = embed_question(client, model, question)
 
     # Start with a cuisine filter if provided
-    candidates: List[Dict] = []
+    rows = np.empty(0, dtype=np.int64)
     if cuisine:
-        cuisine_hits = _filter_by_cuisine(embedded_chunks, cuisine)
-        if cuisine_hits:
-            candidates = cuisine_hits
+        rows = rows_for(cuisine.lower())
 
     # If no cuisine hits, use concourse filter (based on gate)
-    if not candidates:
+    if not len(rows):
         concourse = infer_concourse_from_gate(gate)
         if concourse != "Unknown":
-            candidates = [ch for ch in embedded_chunks if concourse.lower() in ch["text"].lower()]
+            rows = rows_for(concourse.lower())
+
+    # Rank by cosine similarity; if still empty, use all
+    params = None
+    if len(rows):
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(rows))
+    _, ids = index.search(q, k, params=params)
+
+    # Return top k joined as context
+    return "\n\n".join(texts[i] for i in ids[0] if i >= 0)
+
+
+class SemanticCache:
+    """
+    Response cache keyed by query meaning rather than exact text.
+
+    Query embeddings are L2-normalized into a FAISS inner-product index, so a
+    lookup returns the stored response when cosine similarity >= threshold.
+    With a path, the cache is reloaded on start and flushed to <path>.npz every
+    `save_every` adds.
+    With a ttl (seconds), older entries count as misses and are dropped once
+    they make up half the index; loaded entries start their clock at load time.
+    """
+
+    def __init__(self, threshold: float = 0.95, path: Optional[str] = None, save_every: int = 20,
+                 ttl: Optional[float] = None):
+        self.threshold = threshold
+        self.path = path
+        self.save_every = save_every
+        self.ttl = ttl
+        self.index = None
+        self.responses: List = []
+        self._added: List[float] = []
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    @staticmethod
+    def _as_query(embedding) -> np.ndarray:
+        q = np.array(embedding, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(q)
+        return q
+
+    def get(self, embedding):
+        q = self._as_query(embedding)
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                return None
+            scores, ids = self.index.search(q, 1)
+            i = ids[0, 0]
+            if scores[0, 0] >= self.threshold and not self._expired(i, time.time()):
+                return self.responses[i]
+        return None
+
+    def _expired(self, i: int, now: float) -> bool:
+        return self.ttl is not None and now - self._added[i] > self.ttl
+
+    def _prune(self, now: float):
+        keep = [i for i in range(len(self.responses)) if not self._expired(i, now)]
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)[keep]
+        self.index = faiss.IndexFlatIP(vectors.shape[1])
+        self.index.add(vectors)
+        self.responses = [self.responses[i] for i in keep]
+        self._added = [self._added[i] for i in keep]
 
-    # If still empty, use all
-    if not candidates:
-        candidates = embedded_chunks
+    def add(self, embedding, response):
+        q = self._as_query(embedding)
+        with self._lock:
+            if self.index is None:
+                self.index = faiss.IndexFlatIP(q.shape[1])
+            now = time.time()
+            self.index.add(q)
+            self.responses.append(response)
+            self._added.append(now)
+            self._unsaved += 1
+            # _added is in insertion order, so expired entries are a prefix
+            if self.ttl is not None and 2 * bisect.bisect_left(self._added, now - self.ttl) > len(self._added):
+                self._prune(now)
+            flush = self.path and self._unsaved >= self.save_every
+        if flush:
+            self.save()
 
-    # Rank by cosine similarity
-    sims = []
-    for item in candidates:
-        sims.append((cosine_similarity(q_embedding, item["embedding"]), item["text"]))
-    sims.sort(reverse=True)
+    def load(self):
+        # Index and responses share one file, so they always come from the same save
+        if not os.path.exists(f"{self.path}.npz"):
+            return
+        try:
+            with np.load(f"{self.path}.npz") as f:
+                index = faiss.deserialize_index(f["index"])
+                responses = orjson.loads(f["responses"].tobytes())
+        except Exception as e:
+            print(f"[WARN] Ignoring unreadable semantic cache {self.path}: {e}")
+            return
+        if index.ntotal == len(responses):
+            self.index, self.responses = index, responses
+            self._added = [time.time()] * len(responses)
 
-    # Return top 3 joined as context
-    top = [t for _, t in sims[:3]]
-    return "\n\n".join(top)
+    def save(self):
+        """Flush to <path>.npz. Never raises: a cache that can't be written is only logged."""
+        if not self.path:
+            return
+        try:
+            with self._lock:
+                if self.index is None:
+                    return
+                index_bytes = faiss.serialize_index(self.index)
+                payload = orjson.dumps(self.responses)
+                self._unsaved = 0
+            buf = io.BytesIO()
+            np.savez(buf, index=index_bytes, responses=np.frombuffer(payload, dtype=np.uint8))
+            atomic_write(f"{self.path}.npz", buf.getvalue())
+        except Exception as e:
+            print(f"[WARN] Could not write semantic cache {self.path}: {e}")
@@ -3,21 +3,26 @@
 from openai import AzureOpenAI
 from dotenv import load_dotenv
 import os
-import json
+import orjson
 import re
+from collections import Counter
+from functools import lru_cache
 from flask import Flask, render_template, request, jsonify
+from smart import OrjsonProvider, pooled_http_client, jsonl_lines
 
 # --- Step 1: Load environment variables and set up Azure OpenAI client ---
 load_dotenv()
 client = AzureOpenAI(
     azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
     api_key=os.getenv("AZURE_OPENAI_KEY"),
-    api_version="2023-12-01-preview"
+    api_version="2023-12-01-preview",
+    http_client=pooled_http_client()
 )
 CHAT_MODEL = os.getenv("AZURE_CHAT_DEPLOYMENT")
 
 # --- Step 2: Flask App Setup ---
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # --- Step 3: Load Airport Data and define Keywords ---
 AIRPORT_DATA_FILE = "data/catalog.jsonl"
@@ -40,27 +45,27 @@ def load_airport_data():
     AIRPORT_DATA = []
     if os.path.exists(AIRPORT_DATA_FILE):
         try:
-            with open(AIRPORT_DATA_FILE, 'r', encoding='utf-8') as f:
-                for line in f:
-                    stripped_line = line.strip()
-                    if stripped_line:
-                        try:
-                            AIRPORT_DATA.append(json.loads(stripped_line))
-                        except json.JSONDecodeError as e:
-                            print(f"Error decoding JSON object from line: {e}")
-                            print(f"Problematic line: {stripped_line}")
+            # orjson parses each line straight out of the memory-mapped file
+            for line in jsonl_lines(AIRPORT_DATA_FILE):
+                try:
+                    AIRPORT_DATA.append(orjson.loads(line))
+                except orjson.JSONDecodeError as e:
+                    print(f"Error decoding JSON object from line: {e}")
+                    print(f"Problematic line: {bytes(line).decode('utf-8', 'replace')}")
             print(f"Successfully loaded {len(AIRPORT_DATA)} items from {AIRPORT_DATA_FILE}")
         except Exception as e:
             print(f"Error loading {AIRPORT_DATA_FILE}: {e}")
             AIRPORT_DATA = []
     else:
         print(f"Warning: {AIRPORT_DATA_FILE} not found. Recommendations will not be airport-specific.")
+    categorize_airport_data()
 
 def get_location_name(location_data):
     """Converts location concourse and floor data into a human-readable name."""
-    concourse = location_data.get('concourse', '')
-    floor = location_data.get('floor', '')
-    
+    return _format_location(location_data.get('concourse', ''), location_data.get('floor', ''))
+
+@lru_cache(maxsize=4096)
+def _format_location(concourse, floor):
     if concourse and floor:
         # Check if the concourse and floor are not null or empty
         if concourse.strip() and floor.strip():
@@ -77,21 +82,17 @@ def get_location_name(location_data):
 def get_top_popular_items():
     """Analyzes airport data to find the most popular items in each category."""
     global POPULAR_ITEMS
-    category_counts = {
-        "shop": {},
-        "dine": {},
-        "relax": {}
-    }
+    category_counts = {category: Counter() for category in ("shop", "dine", "relax")}
     for item in AIRPORT_DATA:
         entity_type = item.get("entity_type", "").lower()
         if entity_type in category_counts:
             title = item.get("title", "")
             if title:
-                category_counts[entity_type][title] = category_counts[entity_type].get(title, 0) + 1
+                category_counts[entity_type][title] += 1
     
     for category in POPULAR_ITEMS.keys():
-        sorted_items = sorted(category_counts[category].items(), key=lambda x: x[1], reverse=True)
-        POPULAR_ITEMS[category] = [item[0] for item in sorted_items[:3]]
+        # most_common keeps first-seen order on ties, like the stable sort it replaces
+        POPULAR_ITEMS[category] = [title for title, _ in category_counts[category].most_common(3)]
 
 # --- Step 4: Functions for User Data Persistence ---
 USER_DATA_FILE = "user_data.json"
@@ -99,46 +100,50 @@ USER_DATA_FILE = "user_data.json"
 def load_user_data_from_file():
     """Loads user data from a JSON file."""
     if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, 'r') as f:
-            return json.load(f)
+        with open(USER_DATA_FILE, 'rb') as f:
+            return orjson.loads(f.read())
     return {}
 
 def save_user_data_to_file(data):
     """Saves user data to a JSON file."""
-    with open(USER_DATA_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+    with open(USER_DATA_FILE, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
 # --- Step 5: New & Improved Recommendation Logic ---
-def get_category_from_keywords(item, keywords_map):
+KEYWORDS_MAP = {
+    "shop": shop_keywords,
+    "dine": dine_keywords,
+    "relax": relax_keywords
+}
+
+# category -> [(item, lowercased content, lowercased description)], built once by
+# load_airport_data since neither categorization nor the lowered text depends on the passenger
+CATEGORIZED_DATA = {category: [] for category in KEYWORDS_MAP}
+
+# One alternation per category: the regex engine finds any keyword in a single
+# C-level pass over the content instead of one `in` probe per keyword
+KEYWORD_RES = {
+    category: re.compile("|".join(re.escape(k) for k in keywords))
+    for category, keywords in KEYWORDS_MAP.items()
+}
+
+def get_category_from_keywords(item):
     """Determines the category of an item based on its keywords."""
-    all_keywords = item.get('keywords', []) + item.get('synonyms', [])
     content = item.get('content', '').lower()
+    tags = {tag.lower() for tag in item.get('tags', [])}
     
-    for category, keywords in keywords_map.items():
-        for keyword in keywords:
-            if keyword in content:
-                return category
-            
-            # Check for keyword matches in the tags
-            if any(tag.lower() == keyword for tag in item.get('tags', [])):
-                return category
+    for category, keywords in KEYWORDS_MAP.items():
+        if KEYWORD_RES[category].search(content):
+            return category
+        # Check for keyword matches in the tags
+        if not tags.isdisjoint(keywords):
+            return category
     return 'unspecified'
 
-def filter_recommendations(interests, travel_purpose, country_of_origin):
-    """
-    Selects the best recommendations based on a scoring system.
-    """
-    categorized_data = {
-        "shop": [],
-        "dine": [],
-        "relax": []
-    }
-    
-    keywords_map = {
-        "shop": shop_keywords,
-        "dine": dine_keywords,
-        "relax": relax_keywords
-    }
+def categorize_airport_data():
+    """Buckets AIRPORT_DATA by entity_type and keyword category into CATEGORIZED_DATA."""
+    global CATEGORIZED_DATA
+    categorized_data = {category: [] for category in KEYWORDS_MAP}
     
     # First, categorize items based on both entity_type and new keywords
     for item in AIRPORT_DATA:
@@ -147,30 +152,41 @@ def filter_recommendations(interests, travel_purpose, country_of_origin):
             categorized_data[entity_type].append(item)
             
         # Use keywords as a fallback or secondary categorization
-        keyword_category = get_category_from_keywords(item, keywords_map)
+        keyword_category = get_category_from_keywords(item)
         if keyword_category != 'unspecified' and item not in categorized_data.get(keyword_category, []):
             categorized_data[keyword_category].append(item)
 
+    CATEGORIZED_DATA = {
+        category: [(item, item.get('content', '').lower(), item.get('description', '').lower()) for item in items]
+        for category, items in categorized_data.items()
+    }
+
+def filter_recommendations(interests, travel_purpose, country_of_origin):
+    """
+    Selects the best recommendations based on a scoring system.
+    """
+    interests_lower = [interest.lower() for interest in interests or []]
+    purpose_lower = travel_purpose.lower()
+    country_lower = country_of_origin.lower() if country_of_origin else ""
 
     recommendations = {}
     
-    for category, items in categorized_data.items():
+    for category, entries in CATEGORIZED_DATA.items():
         best_item = None
         best_score = -1
 
-        for item in items:
+        for item, content, description in entries:
             score = 0
             
             # Factor 1: Interest match (highest priority)
-            if interests:
-                for interest in interests:
-                    if interest.lower() in item.get('content', '').lower() or interest.lower() in item.get('tags', []):
-                        score += 5
+            for interest in interests_lower:
+                if interest in content or interest in item.get('tags', []):
+                    score += 5
             
             # Factor 2: Country of Origin match for dining
-            if category == 'dine' and country_of_origin and item.get('cuisine'):
+            if category == 'dine' and country_lower and item.get('cuisine'):
                 cuisine_list = item['cuisine']
-                if any(country_of_origin.lower() in c.lower() for c in cuisine_list):
+                if any(country_lower in c.lower() for c in cuisine_list):
                     score += 4
                     
             # Factor 3: Specific location provided
@@ -178,7 +194,7 @@ def filter_recommendations(interests, travel_purpose, country_of_origin):
                 score += 3
             
             # Factor 4: Match travel purpose
-            if travel_purpose and travel_purpose.lower() in item.get('description', '').lower() or travel_purpose.lower() in item.get('keywords', []):
+            if travel_purpose and purpose_lower in description or purpose_lower in item.get('keywords', []):
                 score += 2
 
             # Factor 5: Popularity (as a tie-breaker or general boost)
@@ -191,8 +207,8 @@ def filter_recommendations(interests, travel_purpose, country_of_origin):
             
         if best_item:
             recommendations[category] = [best_item]
-        elif items:
-            recommendations[category] = [items[0]]
+        elif entries:
+            recommendations[category] = [entries[0][0]]
         else:
             recommendations[category] = []
     
@@ -308,4 +324,4 @@ if __name__ == "__main__":
     load_airport_data()
     get_top_popular_items()
     print("Starting the Travel Recommendation Engine web server...\n")
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1")
\ No newline at end of file